@@ -1,9 +1,11 @@
-from collections import defaultdict
+from functools import lru_cache
 from typing import List
 import matplotlib.pyplot as plt
 from records import matches, initial_ratings, game_characteristic
 from datetime import date
-from math import sqrt
+from math import sqrt, log, exp
+import numpy as np
+from numba import njit
 import plotly.express as px
 import plotly.graph_objects as go
 
@@ -13,39 +15,40 @@ DIFF = 800
 CHANGE_PER_GAME = 60  # how much does winner get awarded
 ALPHA = 1.1  # how much does 1st pos win compared to 2nd and 3rd (only matter in 2+ player games)
 OFFSET_PER_GAME = 2
+RATING_DTYPE = np.float32  # ratings stay within a few thousand, float64 is overkill
+PLAYERS = list(initial_ratings)
+PLAYER_INDEX = {name: i for i, name in enumerate(PLAYERS)}
 
 
 class History:
-    def __init__(self, init_ratings) -> None:
-        self._ratings = init_ratings
-        self.history_ratings = defaultdict(list)
-        self._ratings_by_dates = defaultdict(lambda: defaultdict(int))
-        self._unique_dates = set()
-        self.update_history()
-        self.track_ratings_by_dates(date(2022, 10, 1))
-
-    def update_history(self):
-        for p, r in self._ratings.items():
-            self.history_ratings[p].append(r)
-
-    def track_ratings_by_dates(self, date):
-        for p, r in self._ratings.items():
-            self._ratings_by_dates[p][date] = r
-        self._unique_dates.add(date)
+    def __init__(self, players, hist, dates) -> None:
+        self._names = list(players)
+        # Row t holds the ratings after t matches, see `replay_matches`
+        self._hist = hist
+        # Last row of each date, in order of first appearance
+        self._rows_by_dates = {}
+        for t, d in enumerate(dates):
+            self._rows_by_dates[d] = t
+
+    @property
+    def ratings(self):
+        """Current rating of all players, in the order of `players`"""
+        return self._hist[-1]
 
     @property
     def curr_ratings(self):
         """Track current rating of all players"""
-        return self._ratings | {"Avg": self._average}
+        return dict(zip(self._names, self.ratings.tolist())) | {"Avg": self._average}
 
     @property
     def players(self):
-        return list(self._ratings.keys())
+        return list(self._names)
 
     @property
     def ratings_by_play(self):
         rv = {}
-        for player, ratings in self.history_ratings.items():
+        for j, player in enumerate(self._names):
+            ratings = self._hist[:, j].tolist()
             plays = list(range(len(ratings)))
             start = end = None
             for i, (r1, r2) in enumerate(zip(ratings, ratings[1:])):
@@ -58,14 +61,15 @@ class History:
         
     @property
     def ratings_by_date(self, use_non_linear_time=True):
-        dates = sorted(list(self._unique_dates))
+        dates = sorted(self._rows_by_dates)
 
         if use_non_linear_time:
             dates = list(map(str, dates))
 
         rv = {}
-        for player in self.players:
-            ratings = list(self._ratings_by_dates[player].values())
+        by_dates = self._hist[list(self._rows_by_dates.values())]
+        for j, player in enumerate(self._names):
+            ratings = by_dates[:, j].tolist()
             start = end = None
             for i, (r1, r2) in enumerate(zip(ratings, ratings[1:])):
                 if r1 != r2:
@@ -77,13 +81,7 @@ class History:
 
     @property
     def _average(self):
-        return sum(self._ratings.values()) / len(self._ratings)
-
-    @curr_ratings.setter
-    def curr_ratings(self, ratings):
-        ratings.pop("Avg", None)
-        self._ratings = ratings
-        self.update_history()
+        return float(self.ratings.mean())
 
     def __repr__(self) -> str:
         return str(self.curr_ratings)
@@ -112,7 +110,7 @@ for game, score in games:
     print(f"{game:<30} {round(score, 2):>6.2f}")
 
 
-def winning_probability(ratings: dict, diff: int = DIFF):
+def winning_probability(ratings: np.ndarray, diff: int = DIFF) -> np.ndarray:
     """
     Calculate probablity of winning for each player.
 
@@ -124,69 +122,148 @@ def winning_probability(ratings: dict, diff: int = DIFF):
         Player A has 90% chance of winning if R_A = R_B + DIFF.
         In other words, how easy it is for weaker player to breach the gap
     """
-    rv = {}
-    N = len(ratings)
-    for player1, rating1 in ratings.items():
-        num = 0
-        for player2, rating2 in ratings.items():
-            if player1 == player2:
-                continue
-            num += 1 / (1 + 10 ** ((rating2 - rating1) / diff))
-        den = N * (N - 1) / 2
-        rv[player1] = num / den
-    return rv
-
-
-def final_score(pos, no_pos=2):
+    ratings = np.asarray(ratings, dtype=RATING_DTYPE)
+    probs = np.empty(len(ratings), dtype=RATING_DTYPE)
+    _pairwise_probs(ratings, np.arange(len(ratings)), probs, diff)
+    return probs
+
+
+@lru_cache(maxsize=None)
+def _scores_vec(no_pos, alpha=ALPHA):
     """
-    Calculate final score based on winning position.
+    Calculate final score of every winning position.
 
     Parameters
     ----------
-    pos:
-        Final position, 1 is winner, 2 is 2nd winner, ... N is loser
-    no_players:
+    no_pos:
         Number of positions in the game
     alpha:
         How many points 1st winner gets compared to 2nd and 3rd.
         Only matters in games with > 2 final positions
     """
     if no_pos == 1:
-        return 1
-    num = ALPHA ** (no_pos - pos) - 1
-    den = sum(ALPHA ** (no_pos - i) - 1 for i in range(1, no_pos + 1))
-    return num / den
+        nums = [1.0]
+    else:
+        nums = [alpha ** (no_pos - p) - 1 for p in range(1, no_pos + 1)]
+    scores = np.array(nums, dtype=RATING_DTYPE) / sum(nums)
+    scores.flags.writeable = False
+    return scores
 
 
-def calculate_new_ratings(ratings, match, game):
+@njit(cache=True, fastmath=True)
+def _pairwise_probs(ratings, idx, out, diff=DIFF):
     """
-    Calculate new ratings for each player
+    Write the winning probability of each participant into `out`.
 
     Parameters
     ----------
-    all_ratings:
+    ratings:
         Rating of all players
-    match:
-        Match result.
-        [[A], [B, C], [D]] means A ranks 1st, B & C both rank 2nd, D ranks last
+    idx:
+        Index of each participant into `ratings`
+    out:
+        Buffer with room for at least one value per participant
+    diff:
+        See `winning_probability`
+    """
+    n = idx.shape[0]
+    k_exp = np.float32(log(10) / diff)
+    for i in range(n):
+        acc = 0.0
+        for j in range(n):
+            if i != j:
+                acc += 1.0 / (1.0 + exp((ratings[idx[j]] - ratings[idx[i]]) * k_exp))
+        out[i] = acc / (n * (n - 1) / 2)
+
+
+@njit(cache=True, fastmath=True)
+def _elo_kernel(
+    ratings, idx, pos, scores, award, probs, diff=DIFF, offset=OFFSET_PER_GAME
+):
+    """
+    Update ratings of a match's participants in place.
+
+    Parameters
+    ----------
+    ratings:
+        Rating of all players, indexed by PLAYER_INDEX
+    idx:
+        Index of each participant into `ratings`
+    pos:
+        Final position of each participant, 1 is winner, 2 is 2nd winner, ...
+    scores:
+        Final score of each position, see `_scores_vec`
+    award:
+        Adjusted reward of the game, see `game_award`
+    probs:
+        Scratch buffer with room for at least one value per participant
+    """
+    n = idx.shape[0]
+    _pairwise_probs(ratings, idx, probs, diff)
+    for i in range(n):
+        # players sharing a position split its score
+        share = 0
+        for j in range(n):
+            if pos[j] == pos[i]:
+                share += 1
+        score = scores[pos[i] - 1] / share
+        ratings[idx[i]] += award * (n - 1) * (score - probs[i]) + offset
+
+
+@njit(cache=True)
+def _replay_kernel(ratings, offsets, idx, pos, no_pos, awards, score_table):
+    """Run `_elo_kernel` over every encoded match, recording ratings after each"""
+    hist = np.empty((awards.shape[0] + 1, ratings.shape[0]), dtype=ratings.dtype)
+    hist[0] = ratings
+    probs = np.empty(ratings.shape[0], dtype=ratings.dtype)
+    for m in range(awards.shape[0]):
+        a, b = offsets[m], offsets[m + 1]
+        _elo_kernel(
+            ratings, idx[a:b], pos[a:b], score_table[no_pos[m]], awards[m], probs
+        )
+        hist[m + 1] = ratings
+    return hist
+
+
+def replay_matches(ratings, matches):
     """
-    participants = [name for names in match for name in names]
-    player_ratings = {name: ratings[name] for name in participants}
-    winning_chance = winning_probability(player_ratings)
+    Calculate ratings after each match
 
-    player_scores = {}
-    for pos, names in enumerate(match, 1):
-        for name in names:
-            player_scores[name] = final_score(pos, len(match)) / len(names)
+    Parameters
+    ----------
+    ratings:
+        Initial rating of all players, indexed by PLAYER_INDEX
+    matches:
+        Match results in chronological order, see `records.matches`
 
-    new_ratings = dict(ratings)
-    for name in participants:
-        new_ratings[name] += (
-            game_award(game)
-            * (len(participants) - 1)
-            * (player_scores[name] - winning_chance[name])
-        ) + OFFSET_PER_GAME
-    return new_ratings
+    Returns
+    -------
+    Array of shape (len(matches) + 1, len(ratings)), first row is `ratings`
+    """
+    offsets, idx, pos, no_pos, awards = [0], [], [], [], []
+    for *match, (game, _) in matches:
+        for p, names in enumerate(match, 1):
+            for name in names:
+                idx.append(PLAYER_INDEX[name])
+                pos.append(p)
+        offsets.append(len(idx))
+        no_pos.append(len(match))
+        awards.append(game_award(game))
+
+    max_pos = max(no_pos, default=1)
+    score_table = np.zeros((max_pos + 1, max_pos), dtype=RATING_DTYPE)
+    for n in set(no_pos):
+        score_table[n, :n] = _scores_vec(n)
+
+    return _replay_kernel(
+        ratings.copy(),
+        np.array(offsets, dtype=np.int32),
+        np.array(idx, dtype=np.int32),
+        np.array(pos, dtype=np.int32),
+        np.array(no_pos, dtype=np.int32),
+        np.array(awards, dtype=RATING_DTYPE),
+        score_table,
+    )
 
 
 def plot_hist(history: History):
@@ -217,12 +294,10 @@ def plot_hist(history: History):
 
 
 def main():
-    history = History(initial_ratings)
-    for *match, (game, date) in matches:
-        history.curr_ratings = calculate_new_ratings(history.curr_ratings, match, game)
-        history.track_ratings_by_dates(date)
-
-    plot_hist(history)
+    ratings = np.fromiter(initial_ratings.values(), dtype=RATING_DTYPE)
+    hist = replay_matches(ratings, matches)
+    dates = [date(2022, 10, 1)] + [d for *_, (_, d) in matches]
+    plot_hist(History(initial_ratings, hist, dates))
 
 
 if __name__ == "__main__":
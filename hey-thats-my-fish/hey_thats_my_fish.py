@@ -1,9 +1,16 @@
 # %%
 import random
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from functools import lru_cache
+from io import BytesIO
+from itertools import repeat
 from math import sin, cos, pi, ceil
+import numpy as np
 import matplotlib.pyplot as plt
-from matplotlib.patches import RegularPolygon, Circle
-from matplotlib.backends.backend_pdf import PdfPages
+from matplotlib.patches import Circle
+from matplotlib.collections import PatchCollection, PolyCollection
+from pypdf import PdfWriter
 import argparse
 
 DEFAULT_MAP_SIZE = (10, 10)
@@ -12,28 +19,20 @@ FISH_ANGLES = {i: [j / i * 2 * pi for j in range(i)] for i in range(6)}
 COLORS = ["white", "green", "purple", "orange", "red", "blue"]
 FISH_GROUP_RADIUS = [0, 0, 0.2, 0.2, 0.2, 0.2]
 FISH_RADIUS = [0, 0.13, 0.12, 0.11, 0.10, 0.09]
+FISH_COS_SIN = {
+    i: [(FISH_GROUP_RADIUS[i] * cos(a), FISH_GROUP_RADIUS[i] * sin(a)) for a in angles]
+    for i, angles in FISH_ANGLES.items()
+}
+TILE_RADIUS = 0.55
+# Vertices of a pointy-top hexagon tile centred at (0, 0)
+HEX_TEMPLATE = TILE_RADIUS * np.array(
+    [(cos(pi / 2 + k * pi / 3), sin(pi / 2 + k * pi / 3)) for k in range(6)]
+)
 FIVE_TILE_CHANCE = 0.05
 TILES_PERCENTAGE = [-1, 50, 33, 16, -1, -1]
 VERTICLE_SPACING = 0.866667
 ZERO_PERCENTAGES = (0, 10)
 
-parser = argparse.ArgumentParser()
-parser.add_argument(
-    "--rows", type=int, help="Map size in rows", default=DEFAULT_MAP_SIZE[0]
-)
-parser.add_argument(
-    "--cols", type=int, help="Map size in columns", default=DEFAULT_MAP_SIZE[1]
-)
-parser.add_argument(
-    "--shape",
-    help="Shape of the map. DEFAULT: RANDOM",
-    choices=MAP_CHOICES,
-    default="RANDOM",
-)
-parser.add_argument("--no", help="Number of maps to generate", default=1, type=int)
-parser.add_argument("--out", help="Output file name", default="map.pdf")
-args = parser.parse_args()
-
 
 class MapObject:
     def __init__(self, type, size=DEFAULT_MAP_SIZE) -> None:
@@ -50,6 +49,12 @@ class MapObject:
 
     @property
     def map(self) -> list:
+        cells = np.stack([*np.indices(self._map.shape), self._map], axis=-1)
+        return [tuple(cell) for cell in cells.reshape(-1, 3).tolist()]
+
+    @property
+    def grid(self) -> np.ndarray:
+        """Amount of fish on each (row, col) cell, 0 means no tile"""
         return self._map
 
     @property
@@ -76,35 +81,27 @@ class MapObject:
     def tiles_cnt(self) -> tuple:
         return sum(self._ratio[1:])
 
-    def _generate_rect_map(self) -> None:
+    def _generate_rect_map(self) -> np.ndarray:
         """Generate map."""
-        R, C = self.R, self.C
-        fishes = self._generate_fishes(R * C)
-        return [(r, c, fishes.pop()) for r in range(R) for c in range(C)]
+        return self._place_fishes(np.ones((self.R, self.C), dtype=bool))
 
-    def _generate_tri_map(self) -> None:
+    def _generate_tri_map(self) -> np.ndarray:
         """Generate map."""
-        R, C = self.R, self.C
-        fishes = self._generate_fishes(R * (R + 1) // 2)
-        rv = []
-        for r in range(R):
-            for c in range(C):
-                fish = fishes.pop() if r <= c * 2 + 1 < R * 2 - r else 0
-                rv.append((r, c, fish))
-        return rv
-
-    def _generate_diamond_map(self) -> None:
+        rr, cc = np.mgrid[: self.R, : self.C]
+        return self._place_fishes((rr <= cc * 2 + 1) & (cc * 2 + 1 < self.R * 2 - rr))
+
+    def _generate_diamond_map(self) -> np.ndarray:
         """Generate map."""
-        R, C = self.R, self.C
-        fishes = self._generate_fishes(R * R)
-        rv = []
-        for r in range(R):
-            for c in range(C):
-                fish = fishes.pop() if r <= c * 2 + 1 < r + R * 2 else 0
-                rv.append((r, c, fish))
-        return rv
-
-    def _generate_fishes(self, area) -> None:
+        rr, cc = np.mgrid[: self.R, : self.C]
+        return self._place_fishes((rr <= cc * 2 + 1) & (cc * 2 + 1 < rr + self.R * 2))
+
+    def _place_fishes(self, mask) -> np.ndarray:
+        """Scatter random amount of fish onto the cells of the mask."""
+        fishes = np.zeros(mask.shape, dtype=np.int8)
+        fishes[mask] = self._generate_fishes(int(mask.sum()))
+        return fishes
+
+    def _generate_fishes(self, area) -> np.ndarray:
         """Generate random amount of fish for the map."""
         zeroes = random.randint(*ZERO_PERCENTAGES) * area // 100
         fives = 1 if random.randint(0, 100) <= FIVE_TILE_CHANCE * 100 else 0
@@ -113,78 +110,124 @@ class MapObject:
         twos = TILES_PERCENTAGE[2] * area // 100
         threes = TILES_PERCENTAGE[3] * area // 100
         fours = area - ones - twos - threes
-        pts = (
-            [0] * zeroes
-            + [1] * ones
-            + [2] * twos
-            + [3] * threes
-            + [4] * fours
-            + [5] * fives
-        )
-        random.shuffle(pts)
         self._ratio = [zeroes, ones, twos, threes, fours, fives]
+        pts = np.repeat(np.arange(len(self._ratio), dtype=np.int8), self._ratio)
+        np.random.shuffle(pts)
         return pts
 
 
-def add_fishes(ax, x, y, amt):
-    """Add fishes to a tile"""
-    for deg in FISH_ANGLES[amt]:
-        cx = FISH_GROUP_RADIUS[amt] * cos(deg) + x
-        cy = FISH_GROUP_RADIUS[amt] * sin(deg) + y
-        ax.add_patch(Circle((cx, cy), FISH_RADIUS[amt], color=COLORS[amt], alpha=0.5))
+def add_fishes(patches, x, y, amt):
+    """Add fishes of a tile to the patches list"""
+    for dx, dy in FISH_COS_SIN[amt]:
+        patches.append(
+            Circle((x + dx, y + dy), FISH_RADIUS[amt], color=COLORS[amt], alpha=0.5)
+        )
+
+
+@lru_cache(maxsize=None)
+def shared_figure():
+    """Figure and axes reused by every map drawn in this process"""
+    return plt.subplots(1)
 
 
-def add_tile(ax, x, y, amt):
-    """Add a hexagon tile to the map"""
-    ax.add_patch(
-        RegularPolygon(
-            (x, y),
-            numVertices=6,
-            radius=0.55,
-            facecolor=COLORS[amt],
+def generate_map(map_obj: MapObject, ax, rasterized=False):
+    """Draw a map onto ax, clearing whatever was drawn before"""
+    ax.cla()
+    ax.set_aspect("equal")
+    rows, cols = np.indices(map_obj.grid.shape).reshape(2, -1)
+    quantities = map_obj.grid.ravel()
+    centers = np.column_stack([cols + 0.5 * (rows % 2), rows * VERTICLE_SPACING])
+    # One collection per layer is drawn in a single call instead of per patch.
+    # If rasterized, each pdf page embeds one image instead of a path per shape
+    ax.add_collection(
+        PolyCollection(
+            HEX_TEMPLATE + centers[:, None, :],
+            facecolors=[COLORS[amt] for amt in quantities],
+            edgecolors=["black" if amt else "none" for amt in quantities],
+            linewidths=0.2,
             alpha=0.2,
-            edgecolor="black" if amt else "none",
-            linewidth=0.2,
+            rasterized=rasterized,
         )
     )
+    fishes = []
+    for (x, y), quantity in zip(centers.tolist(), quantities.tolist()):
+        add_fishes(fishes, x, y, quantity)
+    ax.add_collection(
+        PatchCollection(fishes, match_original=True, rasterized=rasterized)
+    )
+    ax.set_xlim([-1, map_obj.C])
+    ax.set_ylim([-1, map_obj.R * VERTICLE_SPACING])
+    ax.axis("off")
+
+
+def render_map(i, shape, size, seed, dpi=None):
+    """Generate map number i and render it to a single-page pdf"""
+    # Seed per map, otherwise forked workers would share the parent's state
+    random.seed(seed)
+    np.random.seed(seed)
+    map_obj = MapObject(shape, size)
+    fig, ax = shared_figure()
+    generate_map(map_obj, ax, rasterized=dpi is not None)
+    ax.set_title(
+        f"Map {i}. Type: {map_obj.type}. Size: {map_obj.size}. "
+        f"Ratio: {map_obj.ratio}. Tiles: {map_obj.tiles_cnt}. Total: {map_obj.total}. \n"
+        f"Ref: bit.ly/fish-map-gen",
+        fontsize=7,
+    )
+    buf = BytesIO()
+    fig.savefig(buf, format="pdf", dpi=dpi or "figure")
+    return buf.getvalue()
+
+
+def generate_maps(rows, cols, shape="RANDOM", no=1, out="map.pdf", dpi=None):
+    """Generate a number of maps in parallel and save them to a pdf"""
+    print(f"Generating {no} {shape} maps with size {rows}x{cols}")
+    shapes = [
+        random.choice(MAP_CHOICES) if shape == "RANDOM" else shape for _ in range(no)
+    ]
+    seeds = [random.getrandbits(32) for _ in range(no)]
+    tasks = (range(1, no + 1), shapes, repeat((rows, cols)), seeds, repeat(dpi))
+    writer = PdfWriter()
+    with ExitStack() as stack:
+        # A pool is pure overhead for a single map
+        if no > 1:
+            pages = stack.enter_context(ProcessPoolExecutor()).map(render_map, *tasks)
+        else:
+            pages = map(render_map, *tasks)
+        for i, page in enumerate(pages, 1):
+            writer.append(BytesIO(page))
+            print(f"Generated {i} map")
+    # Every page brings its own copy of fonts and other resources, keep one
+    writer.compress_identical_objects()
+    writer.write(f"./{out}")
+    print("Done. File saved to ./" + out)
 
 
-def generate_map(map_obj: MapObject):
-    """Generate a map and save it to a pdf"""
-    _, ax = plt.subplots(1)
-    ax.set_aspect("equal")
-    for row, col, quantity in map_obj.map:
-        x = col + 0.5 if row % 2 else col
-        y = row * VERTICLE_SPACING
-        add_tile(ax, x, y, quantity)
-        add_fishes(ax, x, y, quantity)
-    plt.xlim([-1, map_obj.C])
-    plt.ylim([-1, map_obj.R * VERTICLE_SPACING])
-    plt.axis("off")
-    return plt
-
-
-def generate_maps(args):
-    """Generate a number of maps and save them to a pdf"""
-    print(f"Generating {args.no} {args.shape} maps with size {args.rows}x{args.cols}")
-    with PdfPages(f"./{args.out}") as pdf:
-        for i in range(1, args.no + 1):
-            shape = args.shape
-            if shape == "RANDOM":
-                shape = random.choice(MAP_CHOICES)
-            map_obj = MapObject(shape, (args.rows, args.cols))
-            plt = generate_map(map_obj)
-            plt.title(
-                f"Map {i}. Type: {map_obj.type}. Size: {map_obj.size}. "
-                f"Ratio: {map_obj.ratio}. Tiles: {map_obj.tiles_cnt}. Total: {map_obj.total}. \n"
-                f"Ref: bit.ly/fish-map-gen",
-                fontsize=7,
-            )
-            pdf.savefig()
-            plt.close()
-            print(f"Generated {i} map")
-    print("Done. File saved to ./" + args.out)
+def _parse_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--rows", type=int, help="Map size in rows", default=DEFAULT_MAP_SIZE[0]
+    )
+    parser.add_argument(
+        "--cols", type=int, help="Map size in columns", default=DEFAULT_MAP_SIZE[1]
+    )
+    parser.add_argument(
+        "--shape",
+        help="Shape of the map. DEFAULT: RANDOM",
+        choices=MAP_CHOICES,
+        default="RANDOM",
+    )
+    parser.add_argument("--no", help="Number of maps to generate", default=1, type=int)
+    parser.add_argument("--out", help="Output file name", default="map.pdf")
+    parser.add_argument(
+        "--dpi",
+        help="Rasterize tiles and fishes at this DPI. DEFAULT: keep them as vectors",
+        type=int,
+    )
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
-    generate_maps(args)
+    args = _parse_args()
+    generate_maps(args.rows, args.cols, args.shape, args.no, args.out, args.dpi)